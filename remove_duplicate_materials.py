@@ -8,256 +8,338 @@ bl_info = {
     "category": "Material",
 }
 
+import logging
+from collections import Counter
+
 import bpy
-import bmesh
+import numpy as np
 from mathutils import Vector, Color
 
+# Debug output goes through logging so it costs a level check when disabled
+DEBUG = False
+
+logger = logging.getLogger(__name__)
+if DEBUG:
+    # The module logger has no handler of its own and the last-resort handler
+    # only shows warnings, so attach one to make debug output visible
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.DEBUG)
+
+# Optional material properties depend on the Blender version, so look them up once.
+# The RNA definition is used instead of a probe material because bpy.data is
+# not accessible while the add-on is being registered.
+_MATERIAL_PROPERTIES = bpy.types.Material.bl_rna.properties
+HAS_METALLIC = 'metallic' in _MATERIAL_PROPERTIES
+HAS_SPECULAR = 'specular' in _MATERIAL_PROPERTIES
+HAS_ROUGHNESS = 'roughness' in _MATERIAL_PROPERTIES
+
 
 def compare_material_properties(mat1, mat2):
     """
     Compare two materials to check if they are identical in all properties except name.
+    Node trees are not compared here; they are part of the material fingerprint.
     Returns True if materials are identical (duplicates).
     """
-    print(f"DEBUG: Comparing materials '{mat1.name if mat1 else 'None'}' and '{mat2.name if mat2 else 'None'}'")
-    
     if mat1 is None or mat2 is None:
-        print("DEBUG: One or both materials are None")
+        logger.debug("One or both materials are None")
         return False
     
-    if mat1 == mat2:  # Same material object
-        print("DEBUG: Same material object - not duplicates")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Comparing materials '%s' and '%s'", mat1.name, mat2.name)
+    
+    if mat1 is mat2:  # Same material object
+        logger.debug("Same material object - not duplicates")
+        return False
+    
+    # Cheapest and most selective checks first so different materials bail out early
+    if mat1.use_nodes != mat2.use_nodes:
+        logger.debug("use_nodes differ: %s vs %s", mat1.use_nodes, mat2.use_nodes)
+        return False
+    if mat1.blend_method != mat2.blend_method:
+        logger.debug("blend_method differ: %s vs %s", mat1.blend_method, mat2.blend_method)
         return False
     
-    # Compare basic material properties that exist in Blender 4.4
+    # Compare remaining basic material properties that exist in Blender 4.4
     try:
-        if mat1.use_nodes != mat2.use_nodes:
-            print(f"DEBUG: use_nodes differ: {mat1.use_nodes} vs {mat2.use_nodes}")
-            return False
-        if mat1.blend_method != mat2.blend_method:
-            print(f"DEBUG: blend_method differ: {mat1.blend_method} vs {mat2.blend_method}")
-            return False
         if abs(mat1.alpha_threshold - mat2.alpha_threshold) > 0.001:
-            print(f"DEBUG: alpha_threshold differ: {mat1.alpha_threshold} vs {mat2.alpha_threshold}")
+            logger.debug("alpha_threshold differ: %s vs %s", mat1.alpha_threshold, mat2.alpha_threshold)
             return False
         if mat1.show_transparent_back != mat2.show_transparent_back:
-            print(f"DEBUG: show_transparent_back differ: {mat1.show_transparent_back} vs {mat2.show_transparent_back}")
+            logger.debug("show_transparent_back differ: %s vs %s", mat1.show_transparent_back, mat2.show_transparent_back)
             return False
         if mat1.use_backface_culling != mat2.use_backface_culling:
-            print(f"DEBUG: use_backface_culling differ: {mat1.use_backface_culling} vs {mat2.use_backface_culling}")
+            logger.debug("use_backface_culling differ: %s vs %s", mat1.use_backface_culling, mat2.use_backface_culling)
             return False
     except AttributeError as e:
-        print(f"DEBUG: AttributeError in basic properties: {e}")
+        logger.debug("AttributeError in basic properties: %s", e)
         # Some properties might not exist in all Blender versions
         pass
     
     # Compare surface properties
     try:
-        # Compare diffuse_color by converting to lists for proper comparison
-        diffuse1 = list(mat1.diffuse_color) if hasattr(mat1.diffuse_color, '__iter__') else [mat1.diffuse_color]
-        diffuse2 = list(mat2.diffuse_color) if hasattr(mat2.diffuse_color, '__iter__') else [mat2.diffuse_color]
-        
-        # Compare with small tolerance for floating point differences
-        if len(diffuse1) != len(diffuse2):
-            print(f"DEBUG: diffuse_color length differ: {len(diffuse1)} vs {len(diffuse2)}")
+        # Compare diffuse_color as rounded tuples, the same way the fingerprint does
+        diffuse1 = _round_color(mat1.diffuse_color)
+        diffuse2 = _round_color(mat2.diffuse_color)
+        if diffuse1 != diffuse2:
+            logger.debug("diffuse_color differ: %s vs %s", diffuse1, diffuse2)
             return False
         
-        for i, (d1, d2) in enumerate(zip(diffuse1, diffuse2)):
-            if abs(d1 - d2) > 0.001:
-                print(f"DEBUG: diffuse_color[{i}] differ: {d1} vs {d2}")
-                return False
-        
         # Handle metallic property safely
-        if hasattr(mat1, 'metallic') and hasattr(mat2, 'metallic'):
-            if abs(mat1.metallic - mat2.metallic) > 0.001:
-                print(f"DEBUG: metallic differ: {mat1.metallic} vs {mat2.metallic}")
-                return False
+        if HAS_METALLIC and abs(mat1.metallic - mat2.metallic) > 0.001:
+            logger.debug("metallic differ: %s vs %s", mat1.metallic, mat2.metallic)
+            return False
         
         # Handle specular property safely (may not exist in newer Blender versions)
-        if hasattr(mat1, 'specular') and hasattr(mat2, 'specular'):
-            if abs(mat1.specular - mat2.specular) > 0.001:
-                print(f"DEBUG: specular differ: {mat1.specular} vs {mat2.specular}")
-                return False
-        elif hasattr(mat1, 'specular') != hasattr(mat2, 'specular'):
-            print(f"DEBUG: Only one material has specular property")
+        if HAS_SPECULAR and abs(mat1.specular - mat2.specular) > 0.001:
+            logger.debug("specular differ: %s vs %s", mat1.specular, mat2.specular)
             return False
         
         # Handle roughness property safely
-        if hasattr(mat1, 'roughness') and hasattr(mat2, 'roughness'):
-            if abs(mat1.roughness - mat2.roughness) > 0.001:
-                print(f"DEBUG: roughness differ: {mat1.roughness} vs {mat2.roughness}")
-                return False
+        if HAS_ROUGHNESS and abs(mat1.roughness - mat2.roughness) > 0.001:
+            logger.debug("roughness differ: %s vs %s", mat1.roughness, mat2.roughness)
+            return False
         
     except AttributeError as e:
-        print(f"DEBUG: AttributeError in surface properties: {e}")
+        logger.debug("AttributeError in surface properties: %s", e)
         # Continue with comparison even if some properties are missing
         pass
     
-    # If materials use nodes, compare node trees with a more lenient approach
-    if mat1.use_nodes and mat2.use_nodes:
-        if mat1.node_tree is None or mat2.node_tree is None:
-            print("DEBUG: One material has use_nodes=True but no node_tree")
-            return mat1.node_tree == mat2.node_tree
-        
-        # Use a simpler node tree comparison for now
-        nodes_match = len(mat1.node_tree.nodes) == len(mat2.node_tree.nodes)
-        links_match = len(mat1.node_tree.links) == len(mat2.node_tree.links)
-        
-        print(f"DEBUG: Node count match: {nodes_match} ({len(mat1.node_tree.nodes)} vs {len(mat2.node_tree.nodes)})")
-        print(f"DEBUG: Link count match: {links_match} ({len(mat1.node_tree.links)} vs {len(mat2.node_tree.links)})")
-        
-        if not (nodes_match and links_match):
-            return False
-        
-        # For now, if they have the same number of nodes and links, consider them similar
-        # This is a simplified comparison - we could enhance this later
-        print("DEBUG: Node trees considered similar (simplified comparison)")
-    elif mat1.use_nodes != mat2.use_nodes:
-        print("DEBUG: One material uses nodes, the other doesn't")
-        return False
-    
-    print(f"DEBUG: Materials '{mat1.name}' and '{mat2.name}' are considered DUPLICATES!")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Materials '%s' and '%s' are considered DUPLICATES!", mat1.name, mat2.name)
     return True
 
 
-def compare_node_trees(tree1, tree2):
+def _node_signature(node):
     """
-    Compare two node trees to check if they are identical.
-    Returns True if node trees are identical.
+    Return a hashable key describing a node independently of its name.
     """
-    if tree1 is None or tree2 is None:
-        return tree1 == tree2
-    
-    # Compare number of nodes
-    if len(tree1.nodes) != len(tree2.nodes):
-        return False
-    
-    # Compare number of links
-    if len(tree1.links) != len(tree2.links):
-        return False
-    
-    # Create mappings of nodes by type and location for comparison
-    nodes1 = {}
-    nodes2 = {}
+    return (node.type, (round(node.location.x, 2), round(node.location.y, 2)))
+
+
+def _node_key(node):
+    """
+    Return a hashable key of a node's signature, display state and type-specific properties.
+    """
+    return (_node_signature(node), node.hide, _round_color(node.color), _node_properties_key(node))
+
+
+def _link_node_identity(node):
+    """
+    Return a location-free key identifying the node at one end of a link.
+    """
+    return (node.bl_idname, node.hide, _round_color(node.color), _node_properties_key(node))
+
+
+def _link_signature(link):
+    """
+    Return a hashable key describing a link by the nodes and sockets it connects.
+    Each end is tied to its node's properties (e.g. the image of a texture node), so
+    swapping which texture feeds which input changes the signature. Node locations are
+    left out because they drift with UI edits, and sockets are keyed on their stable
+    identifier rather than their localized name.
+    """
+    return (
+        _link_node_identity(link.from_node),
+        link.from_socket.identifier,
+        _link_node_identity(link.to_node),
+        link.to_socket.identifier,
+    )
+
+
+def _node_tree_signature(tree):
+    """
+    Return the node keys and link signatures of a node tree as hashable multisets.
+    Computed once per material and stored in its fingerprint, so trees are compared
+    exactly when materials are bucketed and never re-walked per pair.
+    """
+    if tree is None:
+        return None
     
-    for node in tree1.nodes:
-        key = (node.type, tuple(node.location), node.name if hasattr(node, 'name') else '')
-        if key in nodes1:
-            return False  # Duplicate nodes at same location
-        nodes1[key] = node
+    nodes = frozenset(Counter(map(_node_key, tree.nodes)).items())
+    links = frozenset(Counter(map(_link_signature, tree.links)).items())
+    return (nodes, links)
+
+
+def _socket_defaults(node):
+    """
+    Return the default values of a node's inputs as a tuple rounded to the comparison tolerance.
+    Inputs without a default value (e.g. shader sockets) are recorded as None.
+    """
+    values = []
+    for socket in node.inputs:
+        value = getattr(socket, 'default_value', None)
+        if value is None or isinstance(value, str):
+            values.append(value)
+        elif hasattr(value, '__len__'):
+            values.append(tuple(round(v, 3) for v in value))
+        else:
+            values.append(round(value, 3))
+    return tuple(values)
+
+
+def _node_properties_key(node):
+    """
+    Return a hashable key of the type-specific properties that must match between nodes:
+    input defaults for Principled BSDF, image and interpolation for image textures.
+    """
+    if node.type == 'BSDF_PRINCIPLED':
+        return _socket_defaults(node)
+    if node.type == 'TEX_IMAGE':
+        image = getattr(node, 'image', None)
+        return (image.as_pointer() if image else None, getattr(node, 'interpolation', None))
+    return None
+
+
+def _round_color(color):
+    """
+    Return a color as a tuple rounded to the comparison tolerance.
+    """
+    return tuple(round(c, 3) for c in color)
+
+
+def _material_fingerprint(mat):
+    """
+    Build a hashable fingerprint of the properties compared by compare_material_properties.
+    Floats are rounded so that values within the comparison tolerance share a key.
+    """
+    return (
+        mat.use_nodes,
+        mat.blend_method,
+        round(mat.alpha_threshold, 3),
+        mat.show_transparent_back,
+        mat.use_backface_culling,
+        _round_color(mat.diffuse_color),
+        round(mat.metallic, 3) if HAS_METALLIC else None,
+        round(mat.specular, 3) if HAS_SPECULAR else None,
+        round(mat.roughness, 3) if HAS_ROUGHNESS else None,
+        _node_tree_signature(mat.node_tree) if mat.use_nodes else None,
+    )
+
+
+def find_duplicate_materials(materials):
+    """
+    Find groups of duplicate materials.
+    Returns a dictionary where keys are original materials and values are lists of duplicates.
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("find_duplicate_materials called with %s materials:", len(materials))
+        for i, mat in enumerate(materials):
+            logger.debug("  [%s] %s", i, mat.name if mat else 'None')
     
-    for node in tree2.nodes:
-        key = (node.type, tuple(node.location), node.name if hasattr(node, 'name') else '')
-        if key in nodes2:
-            return False  # Duplicate nodes at same location
-        nodes2[key] = node
+    # Group materials by fingerprint in a single pass instead of comparing every pair
+    buckets = {}
+    processed_ptrs = set()
+    for mat in materials:
+        if mat is None:
+            continue
+        ptr = mat.as_pointer()
+        if ptr in processed_ptrs:
+            continue
+        processed_ptrs.add(ptr)
+        buckets.setdefault(_material_fingerprint(mat), []).append(mat)
     
-    # Check if all nodes from tree1 exist in tree2
-    for key, node1 in nodes1.items():
-        if key not in nodes2:
-            return False
-        
-        node2 = nodes2[key]
+    duplicates = {}
+    for group in buckets.values():
+        if len(group) < 2:
+            continue
         
-        # Compare node-specific properties
-        if not compare_node_properties(node1, node2):
-            return False
-    
-    # Compare links (connections between nodes)
-    links1 = set()
-    links2 = set()
-    
-    for link in tree1.links:
-        link_key = (
-            (link.from_node.type, tuple(link.from_node.location), link.from_socket.name),
-            (link.to_node.type, tuple(link.to_node.location), link.to_socket.name)
-        )
-        links1.add(link_key)
-    
-    for link in tree2.links:
-        link_key = (
-            (link.from_node.type, tuple(link.from_node.location), link.from_socket.name),
-            (link.to_node.type, tuple(link.to_node.location), link.to_socket.name)
-        )
-        links2.add(link_key)
+        # Fingerprint floats are rounded, so confirm matches with the tolerance checks
+        # of compare_material_properties; a mismatch starts its own group
+        originals = []
+        for mat in group:
+            for original in originals:
+                if compare_material_properties(original, mat):
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Found duplicate! '%s' is duplicate of '%s'", mat.name, original.name)
+                    duplicates.setdefault(original, []).append(mat)
+                    break
+            else:
+                originals.append(mat)
     
-    return links1 == links2
+    logger.debug("Found %s groups of duplicates", len(duplicates))
+    return duplicates
 
 
-def compare_node_properties(node1, node2):
+def _remapped_material_indices(mesh, table):
     """
-    Compare properties of two nodes to check if they are identical.
-    Returns True if nodes are identical.
+    Read polygon material indices in bulk and map them through the lookup table
+    (old index -> new index). Indices past the end of the table are left as they are.
+    Returns the remapped index array, or None if the mesh has no polygons.
     """
-    if node1.type != node2.type:
-        return False
-    
-    # Compare common properties based on node type
-    if hasattr(node1, 'color') and hasattr(node2, 'color'):
-        if node1.color != node2.color:
-            return False
-    
-    if hasattr(node1, 'hide') and hasattr(node2, 'hide'):
-        if node1.hide != node2.hide:
-            return False
-    
-    # Compare specific properties for different node types
-    if node1.type == 'BSDF_PRINCIPLED':
-        # Compare input default values
-        for input1, input2 in zip(node1.inputs, node2.inputs):
-            if hasattr(input1, 'default_value') and hasattr(input2, 'default_value'):
-                if input1.default_value != input2.default_value:
-                    return False
-    
-    elif node1.type == 'TEX_IMAGE':
-        if hasattr(node1, 'image') and hasattr(node2, 'image'):
-            if node1.image != node2.image:
-                return False
-        if hasattr(node1, 'interpolation') and hasattr(node2, 'interpolation'):
-            if node1.interpolation != node2.interpolation:
-                return False
+    polygon_count = len(mesh.polygons)
+    if not polygon_count:
+        return None
     
-    # Add more node type comparisons as needed
+    indices = np.empty(polygon_count, dtype=np.int32)
+    mesh.polygons.foreach_get('material_index', indices)
     
-    return True
+    remap = np.arange(max(len(table), int(indices.max()) + 1), dtype=np.int32)
+    remap[:len(table)] = table
+    return remap[indices]
 
 
-def find_duplicate_materials(materials):
+def _meshes_with_object_linked_slots():
     """
-    Find groups of duplicate materials.
-    Returns a dictionary where keys are original materials and values are lists of duplicates.
+    Return the pointers of meshes used by any object with a material slot linked to the object.
     """
-    print(f"DEBUG: find_duplicate_materials called with {len(materials)} materials:")
-    for i, mat in enumerate(materials):
-        print(f"DEBUG:   [{i}] {mat.name if mat else 'None'}")
+    mesh_ptrs = set()
+    for obj in bpy.data.objects:
+        if obj.type == 'MESH' and any(slot.link == 'OBJECT' for slot in obj.material_slots):
+            mesh_ptrs.add(obj.data.as_pointer())
+    return mesh_ptrs
+
+
+def merge_material_slots(mesh, material_mapping, object_linked=False):
+    """
+    Merge material slots according to material_mapping (duplicate slot index -> kept slot index).
+    Polygon material indices are remapped to the compacted slot list with bulk
+    foreach_get/foreach_set, and the slot list is rebuilt once instead of popping each slot.
+    When object_linked is set (some user of the mesh has object-linked slots), the merged
+    slots are popped instead so the other slots keep their link mode and material.
+    Returns the number of slots removed.
+    """
+    if not material_mapping:
+        return 0
     
-    duplicates = {}
-    processed = set()
+    slots = list(mesh.materials)
     
-    for i, mat1 in enumerate(materials):
-        if mat1 in processed:
-            print(f"DEBUG: Material '{mat1.name}' already processed, skipping")
-            continue
-        
-        mat_duplicates = []
-        
-        for j, mat2 in enumerate(materials[i+1:], i+1):
-            if mat2 in processed:
-                print(f"DEBUG: Material '{mat2.name}' already processed, skipping")
-                continue
-            
-            print(f"DEBUG: Comparing materials {i} and {j}")
-            if compare_material_properties(mat1, mat2):
-                print(f"DEBUG: Found duplicate! '{mat2.name}' is duplicate of '{mat1.name}'")
-                mat_duplicates.append(mat2)
-                processed.add(mat2)
+    if object_linked:
+        # Rebuilding the slot list would reset object-linked slots on every user of the mesh,
+        # so point faces at the kept slots and pop the merged ones from highest to lowest
+        merged = np.arange(len(slots), dtype=np.int32)
+        for old_idx, kept_idx in material_mapping.items():
+            merged[old_idx] = kept_idx
+        indices = _remapped_material_indices(mesh, merged)
+        if indices is not None:
+            mesh.polygons.foreach_set('material_index', indices)
         
-        if mat_duplicates:
-            print(f"DEBUG: Adding '{mat1.name}' to duplicates with {len(mat_duplicates)} duplicates")
-            duplicates[mat1] = mat_duplicates
-            processed.add(mat1)
+        for idx in sorted(material_mapping, reverse=True):
+            mesh.materials.pop(index=idx)
+        mesh.update()
+        return len(material_mapping)
     
-    print(f"DEBUG: Found {len(duplicates)} groups of duplicates")
-    return duplicates
+    # New index of every slot once the merged slots are dropped
+    kept_materials = []
+    compact = np.arange(len(slots), dtype=np.int32)
+    for i, mat in enumerate(slots):
+        if i not in material_mapping:
+            compact[i] = len(kept_materials)
+            kept_materials.append(mat)
+    for old_idx, kept_idx in material_mapping.items():
+        compact[old_idx] = compact[kept_idx]
+    
+    indices = _remapped_material_indices(mesh, compact)
+    
+    # Clearing the slots resets polygon material indices, so they are written back afterwards
+    mesh.materials.clear()
+    for mat in kept_materials:
+        mesh.materials.append(mat)
+    
+    if indices is not None:
+        mesh.polygons.foreach_set('material_index', indices)
+    mesh.update()
+    
+    return len(slots) - len(kept_materials)
 
 
 class OBJECT_OT_test_simple(bpy.types.Operator):
@@ -280,135 +362,107 @@ class OBJECT_OT_remove_duplicate_materials(bpy.types.Operator):
     
     @classmethod
     def poll(cls, context):
-        print(f"POLL DEBUG: Selected objects: {len(context.selected_objects)}")
-        print(f"POLL DEBUG: Selected object names: {[obj.name for obj in context.selected_objects]}")
-        result = len(context.selected_objects) > 0
-        print(f"POLL DEBUG: Returning {result}")
-        return result
+        return len(context.selected_objects) > 0
     
     def execute(self, context):
-        print("=" * 50)
-        print("DEBUG: SCRIPT EXECUTION STARTED")
-        print("=" * 50)
+        logger.debug("SCRIPT EXECUTION STARTED")
         
         removed_count = 0
+        replaced_count = 0
         processed_objects = 0
         
-        print(f"DEBUG: Selected objects count: {len(context.selected_objects)}")
+        logger.debug("Selected objects count: %s", len(context.selected_objects))
         
         # Check basic conditions first
         if not context.selected_objects:
-            print("DEBUG: No objects selected!")
+            logger.debug("No objects selected!")
             self.report({'ERROR'}, "No objects selected!")
             return {'CANCELLED'}
         
         # Check if any selected objects are mesh objects
         mesh_objects = [obj for obj in context.selected_objects if obj.type == 'MESH']
         if not mesh_objects:
-            print("DEBUG: No mesh objects selected!")
+            logger.debug("No mesh objects selected!")
             return {'CANCELLED'}
         
-        print(f"DEBUG: Found {len(mesh_objects)} mesh objects to process")
+        # Polygon data is edited in place, so make sure no mesh is held in edit mode
+        if context.mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode='OBJECT')
         
-        # Process all selected mesh objects
-        for obj in context.selected_objects:
-            print(f"DEBUG: Processing object '{obj.name}' of type '{obj.type}'")
-            if obj.type != 'MESH':
-                print(f"DEBUG: Skipping non-mesh object '{obj.name}'")
-                continue
-            
+        logger.debug("Found %s mesh objects to process", len(mesh_objects))
+        
+        # First pass: deduplicate the union of materials used by all selected meshes
+        all_materials = {}
+        for obj in mesh_objects:
+            for mat in obj.data.materials:
+                if mat is not None:
+                    all_materials.setdefault(mat.as_pointer(), mat)
+        
+        logger.debug("Found %s unique materials across selected meshes", len(all_materials))
+        
+        # Meshes are still visited when no duplicates are found, since slots that
+        # repeat the same material are always merged
+        duplicates = find_duplicate_materials(list(all_materials.values()))
+        
+        # Map every duplicate's pointer to the material that replaces it
+        canonical = {}
+        for original, dupe_list in duplicates.items():
+            for duplicate in dupe_list:
+                canonical[duplicate.as_pointer()] = original
+        
+        # Rebuilding slots would reset object-linked slots, so find those meshes in one pass
+        object_linked_meshes = _meshes_with_object_linked_slots()
+        
+        # Second pass: apply the mapping to each mesh
+        for obj in mesh_objects:
             processed_objects += 1
             mesh = obj.data
-            print(f"DEBUG: Processing mesh '{mesh.name}'")
-            
-            if not mesh.materials:
-                print(f"DEBUG: Mesh '{mesh.name}' has no materials")
-                continue
-            
-            # Get all materials from the mesh
-            materials = [mat for mat in mesh.materials if mat is not None]
-            print(f"DEBUG: Found {len(materials)} non-None materials in mesh '{mesh.name}'")
-            print(f"DEBUG: Total material slots: {len(mesh.materials)}")
+            logger.debug("Processing mesh '%s' of object '%s'", mesh.name, obj.name)
             
             # List all materials for debugging
-            for i, mat in enumerate(mesh.materials):
-                if mat:
-                    print(f"DEBUG: Material slot {i}: '{mat.name}'")
-                else:
-                    print(f"DEBUG: Material slot {i}: None")
-            
-            if len(materials) < 2:
-                print(f"DEBUG: Mesh '{mesh.name}' has less than 2 materials, skipping")
-                continue
-            
-            # Find duplicate materials
-            print(f"DEBUG: Calling find_duplicate_materials for mesh '{mesh.name}'")
-            duplicates = find_duplicate_materials(materials)
-            
-            if not duplicates:
-                print(f"DEBUG: No duplicates found for mesh '{mesh.name}'")
-                continue
-            
-            print(f"DEBUG: Found duplicates for mesh '{mesh.name}': {len(duplicates)} groups")
+            if logger.isEnabledFor(logging.DEBUG):
+                for i, mat in enumerate(mesh.materials):
+                    if mat:
+                        logger.debug("Material slot %s: '%s'", i, mat.name)
+                    else:
+                        logger.debug("Material slot %s: None", i)
             
-            # Create material index mapping (duplicate -> original)
+            # Create material index mapping (duplicate slot -> kept slot)
             material_mapping = {}
-            materials_to_remove = set()
             
-            for original, dupe_list in duplicates.items():
-                original_idx = None
-                for i, mat in enumerate(mesh.materials):
-                    if mat == original:
-                        original_idx = i
-                        break
-                
-                if original_idx is None:
-                    print(f"DEBUG: Could not find original material '{original.name}' in mesh material slots")
+            # Slot index kept for each canonical material pointer; a later slot resolving to
+            # the same material (a duplicate or the material itself again) is merged into it
+            kept_slots = {}
+            for i, mat in enumerate(mesh.materials):
+                if mat is None:
                     continue
                 
-                for duplicate in dupe_list:
-                    duplicate_idx = None
-                    for i, mat in enumerate(mesh.materials):
-                        if mat == duplicate:
-                            duplicate_idx = i
-                            break
-                    
-                    if duplicate_idx is not None:
-                        material_mapping[duplicate_idx] = original_idx
-                        materials_to_remove.add(duplicate_idx)
+                original = canonical.get(mat.as_pointer(), mat)
+                original_ptr = original.as_pointer()
+                kept_idx = kept_slots.get(original_ptr)
+                
+                if kept_idx is None:
+                    # First slot for this material; point it at the original if needed
+                    kept_slots[original_ptr] = i
+                    if original_ptr != mat.as_pointer():
+                        logger.debug("Replacing '%s' with '%s' in slot %s", mat.name, original.name, i)
+                        mesh.materials[i] = original
+                        replaced_count += 1
+                else:
+                    logger.debug("Merging slot %s ('%s') into slot %s", i, mat.name, kept_idx)
+                    material_mapping[i] = kept_idx
             
             if not material_mapping:
-                print("DEBUG: No material mapping created, continuing to next object")
+                logger.debug("No material mapping created, continuing to next object")
                 continue
             
-            # Enter edit mode to access polygon data
-            context.view_layer.objects.active = obj
-            bpy.context.view_layer.update()
-            
-            # Switch to edit mode
-            bpy.ops.object.mode_set(mode='EDIT')
-            
-            # Get bmesh representation
-            bm = bmesh.from_edit_mesh(mesh)
-            
-            # Reassign materials for faces
-            for face in bm.faces:
-                if face.material_index in material_mapping:
-                    face.material_index = material_mapping[face.material_index]
-            
-            # Update mesh
-            bmesh.update_edit_mesh(mesh)
-            bpy.ops.object.mode_set(mode='OBJECT')
-            
-            # Remove duplicate material slots (from highest index to lowest)
-            material_indices_to_remove = sorted(materials_to_remove, reverse=True)
-            for idx in material_indices_to_remove:
-                if idx < len(mesh.materials):
-                    mesh.materials.pop(index=idx)
-                    removed_count += 1
+            # Reassign materials for faces and drop the duplicate slots
+            removed_count += merge_material_slots(
+                mesh, material_mapping, mesh.as_pointer() in object_linked_meshes)
         
-        if removed_count > 0:
-            print(f"Removed {removed_count} duplicate materials from {processed_objects} objects")
+        if removed_count > 0 or replaced_count > 0:
+            print(f"Removed {removed_count} duplicate materials and replaced {replaced_count} "
+                  f"with their originals in {processed_objects} objects")
         else:
             print("No duplicate materials found")
         